@@ -1,11 +1,15 @@
 import os
-import json
+import contextlib
+import hashlib
 import logging
 import io
+import re
+import zipfile
 from pathlib import Path
+import orjson
 from ebooklib import epub
 from collections import defaultdict
-from bs4 import BeautifulSoup  # для поиска <img src="imgs/...">
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
 logging.basicConfig(
@@ -14,11 +18,83 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 
+# JPEG в RGB до такого размера кладём в книгу как есть, без перекодирования
+JPEG_PASSTHROUGH_MAX_BYTES = 512 * 1024
+
+# Уже сжатые форматы: deflate их не уменьшает, поэтому кладём в архив без сжатия
+_STORED_MEDIA_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# Уровень deflate для текста (XHTML, CSS, NCX и т.д.)
+ZIP_COMPRESSLEVEL = 9
+
+# Тег <img> с локальной картинкой в HTML главы: <img ... src="imgs/...">
+_LOCAL_IMG_RE = re.compile(r'<img\b[^>]*?(?<![\w-])src="(imgs/[^"]+)"[^>]*>', re.IGNORECASE)
+
+
+def _compress_image_worker(img_path, quality, max_dim):
+    """
+    Сжимаем (конвертируем) картинку в JPEG и возвращаем байты.
+    Картинки больше max_dim уменьшаем с сохранением пропорций.
+    Небольшие RGB JPEG, влезающие в max_dim, отдаём как есть: повторное сжатие JPEG
+    только добавляет артефакты и почти не уменьшает размер.
+    Функция модульного уровня, чтобы её можно было отдать в ProcessPoolExecutor.
+    """
+    try:
+        with Image.open(img_path) as im:
+            if (im.format == "JPEG" and im.mode == "RGB"
+                    and max(im.size) <= max_dim
+                    and img_path.stat().st_size <= JPEG_PASSTHROUGH_MAX_BYTES):
+                return img_path.read_bytes()
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            # no-op, если картинка уже меньше
+            im.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, format="JPEG", optimize=True, quality=quality, progressive=True)
+            return buf.getvalue()
+    except Exception as e:
+        logging.warning(f"Ошибка сжатия {img_path}: {e}")
+        return img_path.read_bytes()
+
+
+def _vol_key(v):
+    """Сортируем ключи "томов" как числа, но если вдруг не число - как строку."""
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return v
+
+
+class _EpubWriter(epub.EpubWriter):
+    """
+    EpubWriter с выбором сжатия для каждого файла: картинки пишутся в архив
+    как есть (ZIP_STORED), остальное - deflate с уровнем ZIP_COMPRESSLEVEL.
+    """
+
+    def _write_items(self):
+        folder = self.book.FOLDER_NAME
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                name, data = f"{folder}/{item.file_name}", self._get_ncx()
+            elif isinstance(item, epub.EpubNav):
+                name, data = f"{folder}/{item.file_name}", self._get_nav(item)
+            elif item.manifest:
+                name, data = f"{folder}/{item.file_name}", item.get_content()
+            else:
+                name, data = item.file_name, item.get_content()
+
+            if item.media_type in _STORED_MEDIA_TYPES:
+                self.out.writestr(name, data, compress_type=zipfile.ZIP_STORED)
+            else:
+                self.out.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED,
+                                  compresslevel=ZIP_COMPRESSLEVEL)
+
+
 class EpubCreator:
-    def __init__(self, ranobe_json_path, image_quality=85):
+    def __init__(self, ranobe_json_path, image_quality=85, max_image_dim=1600):
         """
         :param ranobe_json_path: путь к ranobe.json
         :param image_quality: качество JPEG, по умолч. 85
+        :param max_image_dim: макс. ширина/высота картинки в пикселях, по умолч. 1600
         """
         self.ranobe_path = Path(ranobe_json_path)
         if not self.ranobe_path.exists():
@@ -26,10 +102,23 @@ class EpubCreator:
 
         self.base_dir = self.ranobe_path.parent
         self.image_quality = image_quality
-        self._image_cache = {}  # кэш сжатых изображений
+        self.max_image_dim = max_image_dim
+        self._raw_html = {}  # id главы -> исходный HTML (строится один раз в _collect_image_paths)
+        self._path_to_item = {}  # путь к картинке -> EpubItem (повторная ссылка не сжимается заново)
+        self._compress_futures = {}  # путь -> Future с байтами, сжатие в пуле процессов
+        self._content_hash_to_item = {}  # sha1 сжатых байт -> EpubItem (одинаковые картинки кладём один раз)
 
-        with open(self.ranobe_path, "r", encoding="utf-8") as f:
-            self.ranobe_data = json.load(f)
+        self.ranobe_data = orjson.loads(self.ranobe_path.read_bytes())
+
+        # Группируем главы по томам за один проход; тома и главы внутри тома
+        # сортируем один раз, дальше только читаем.
+        self.volumes_map = defaultdict(list)
+        for ch in self.ranobe_data["chapters"]:
+            self.volumes_map[ch["volume"]].append(ch)
+        for chapters in self.volumes_map.values():
+            chapters.sort(key=lambda c: float(c["chapter"]))
+        self.sorted_vols = sorted(self.volumes_map, key=_vol_key)
+        self.first_volume = self.sorted_vols[0] if self.sorted_vols else None
 
         self.book = epub.EpubBook()
 
@@ -50,89 +139,83 @@ class EpubCreator:
         style_item = self._create_style()
         self.book.add_item(style_item)
 
-        spine = ["nav"]
         toc = []
 
-        # Обложка
-        if self.ranobe_data.get("cover_image"):
-            cover_fullpath = self.base_dir / self.ranobe_data["cover_image"]
-            if cover_fullpath.exists():
-                try:
-                    # Создаём страницу cover.xhtml
-                    cover_page = epub.EpubHtml(
-                        title="Cover",
-                        file_name="cover.xhtml",
-                        content='<div style="text-align:center;"><img src="images/cover.jpg" alt="cover" /></div>'
-                    )
-                    cover_page.add_item(style_item)
-                    self.book.add_item(cover_page)
-
-                    # Добавляем в spine
-                    spine.insert(0, cover_page)
-
-                    # Сжимаем и делаем set_cover
-                    cov_data = self._compress_image(cover_fullpath)
-                    self.book.set_cover("images/cover.jpg", cov_data)
-                except Exception as e:
-                    logging.warning(f"Не удалось обработать обложку: {e}")
-
-        # Титульная страница
-        title_page = self._make_title_page(style_item)
-        self.book.add_item(title_page)
-        spine.append(title_page)
-        toc.append(title_page)
-
-        # Группируем главы по томам
-        volumes_map = defaultdict(list)
-        for ch in self.ranobe_data["chapters"]:
-            volumes_map[ch["volume"]].append(ch)
-
-        # Сортируем ключи "томов" как числа, но если вдруг не число - как строку
-        def _vol_key(v):
-            try:
-                return float(v)
-            except:
-                return v
-
-        sorted_vols = sorted(volumes_map.keys(), key=_vol_key)
-
-        volumes_for_toc = []
-
-        for vol in sorted_vols:
-            vol_title = f"Том {vol}"
-            vol_filename = f"volume_{vol}.xhtml"
-            vol_content_parts = [f'<h2 id="volume_{vol}">{vol_title}</h2>']
-            chapters_toc = []
-
-            # Сортируем главы по номеру
-            chapters = sorted(volumes_map[vol], key=lambda c: float(c["chapter"]))
-            for cinfo in chapters:
-                ch_id = cinfo["id"]
-                ch_title = f"Глава {cinfo['chapter']} - {cinfo['name']}"
-                anchor = f"chapter_{ch_id}"
-
-                vol_content_parts.append(f'<h3 id="{anchor}">{ch_title}</h3>')
-
-                # Обрабатываем контент 
-                chapter_html = self._process_chapter_content(
-                    cinfo["content"],
-                    cinfo.get("attachments", [])
+        # Картинки сжимаем параллельно в отдельных процессах (обходим GIL):
+        # ставим всё в пул заранее, а забираем по мере сборки страниц.
+        # Процессов не больше, чем картинок; одну картинку (например, только
+        # обложку) дешевле сжать на месте, чем поднимать пул.
+        image_paths = self._collect_image_paths()
+        pool = None
+        if len(image_paths) > 1:
+            pool = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(image_paths)))
+        with pool or contextlib.nullcontext():
+            if pool is not None:
+                self._start_image_compression(pool, image_paths)
+
+            # Обложка
+            cover_page = None
+            if self.ranobe_data.get("cover_image"):
+                cover_fullpath = self.base_dir / self.ranobe_data["cover_image"]
+                if cover_fullpath.exists():
+                    try:
+                        # Сжимаем и делаем set_cover
+                        cov_data = self._compress_image(cover_fullpath)
+                        self.book.set_cover("images/cover.jpg", cov_data)
+
+                        # Создаём страницу cover.xhtml
+                        cover_page = epub.EpubHtml(
+                            title="Cover",
+                            file_name="cover.xhtml",
+                            content='<div style="text-align:center;"><img src="images/cover.jpg" alt="cover" /></div>'
+                        )
+                        cover_page.add_item(style_item)
+                        self.book.add_item(cover_page)
+                    except Exception as e:
+                        cover_page = None
+                        logging.warning(f"Не удалось обработать обложку: {e}")
+
+            # Обложка (если есть) идёт первой, затем оглавление
+            spine = [cover_page, "nav"] if cover_page else ["nav"]
+
+            # Титульная страница
+            title_page = self._make_title_page(style_item)
+            self.book.add_item(title_page)
+            spine.append(title_page)
+            toc.append(title_page)
+
+            volumes_for_toc = []
+
+            for vol in self.sorted_vols:
+                vol_title = f"Том {vol}"
+                vol_filename = f"volume_{vol}.xhtml"
+                vol_content_parts = [f'<h2 id="volume_{vol}">{vol_title}</h2>']
+                chapters_toc = []
+
+                for cinfo in self.volumes_map[vol]:
+                    ch_id = cinfo["id"]
+                    ch_title = f"Глава {cinfo['chapter']} - {cinfo['name']}"
+                    anchor = f"chapter_{ch_id}"
+
+                    vol_content_parts.append(f'<h3 id="{anchor}">{ch_title}</h3>')
+
+                    # Обрабатываем контент (HTML главы уже построен в _collect_image_paths)
+                    chapter_html = self._process_chapter_content(self._raw_html.pop(ch_id))
+                    vol_content_parts.append(chapter_html)
+
+                    chapters_toc.append((anchor, ch_title))
+
+                # Создаём EpubHtml для всего тома
+                vol_html = epub.EpubHtml(
+                    title=vol_title,
+                    file_name=vol_filename,
+                    content="\n".join(vol_content_parts)
                 )
-                vol_content_parts.append(chapter_html)
-
-                chapters_toc.append((anchor, ch_title))
-
-            # Создаём EpubHtml для всего тома
-            vol_html = epub.EpubHtml(
-                title=vol_title,
-                file_name=vol_filename,
-                content="\n".join(vol_content_parts)
-            )
-            vol_html.add_item(style_item)
-            self.book.add_item(vol_html)
-            spine.append(vol_html)
+                vol_html.add_item(style_item)
+                self.book.add_item(vol_html)
+                spine.append(vol_html)
 
-            volumes_for_toc.append((vol_title, vol_filename, chapters_toc))
+                volumes_for_toc.append((vol_title, vol_filename, chapters_toc))
 
         # Формируем многоуровневое TOC
         for (v_title, v_fname, chap_list) in volumes_for_toc:
@@ -152,57 +235,77 @@ class EpubCreator:
         # Сохраняем
         out_name = f"{self.ranobe_data['title']}.epub"
         out_path = self.base_dir / out_name
-        epub.write_epub(str(out_path), self.book, {})
+        # Собираем архив в памяти и пишем на диск одним write() вместо множества мелких
+        buf = io.BytesIO()
+        writer = _EpubWriter(buf, self.book, {"compresslevel": ZIP_COMPRESSLEVEL})
+        writer.process()
+        writer.write()
+        out_path.write_bytes(buf.getbuffer())
         logging.info(f"EPUB создан: {out_path}")
         return str(out_path)
 
-    def _process_chapter_content(self, content, attachments):
+    def _process_chapter_content(self, raw_html):
         """
-        content может быть:
-          - строка HTML
-          - объект типа {"type": "doc", ...} (ProseMirror-формат)
-          - что-то ещё (None и т.д.)
-        Если doc-формат, конвертируем в HTML через _doc_to_html.
-        Далее создаём BeautifulSoup, ищем <img src="imgs/...">,
-        сжимаем и добавляем в EPUB, подменяя src="images/...".
+        raw_html - исходный HTML главы из _chapter_raw_html.
+        Одним проходом регулярки ищем <img src="imgs/..."> (их уже нормализовал
+        fix_img_links_in_html), сжимаем картинки, добавляем в EPUB и подменяем
+        тег на <img src="images/..."/>. HTML заново не разбираем.
+        Картинки с одинаковым содержимым добавляются в EPUB один раз.
+        """
+        if not raw_html:
+            return ""
+
+        return _LOCAL_IMG_RE.sub(self._rewrite_img, raw_html)
+
+    def _rewrite_img(self, match):
+        """
+        Колбэк для re.sub: <img ... src="imgs/файл"> -> <img src="images/файл"/>.
+        Сжимает картинку и добавляет её в книгу (одинаковые по содержимому - один раз).
+        """
+        old_src = match.group(1)
+        local_file = self.base_dir / old_src  # "output/imgs/filename.jpg" и т.п.
+
+        # Эту картинку уже добавляли - просто ссылаемся на неё
+        item = self._path_to_item.get(local_file)
+        if item is not None:
+            return f'<img src="{item.file_name}"/>'
+
+        if not local_file.exists():
+            logging.warning(f"Файл {local_file} не найден, пропускаем.")
+            return match.group(0)
+
+        # Сжать + добавить
+        new_data = self._compress_image(local_file)
+        digest = hashlib.sha1(new_data).digest()
+        item = self._content_hash_to_item.get(digest)
+        if item is None:
+            # Добавляем в книгу
+            item = epub.EpubItem(
+                uid=f"img_{os.path.basename(old_src)}",
+                file_name="images/" + os.path.basename(local_file),
+                media_type="image/jpeg",
+                content=new_data
+            )
+            self.book.add_item(item)
+            self._content_hash_to_item[digest] = item
+        self._path_to_item[local_file] = item
+
+        # Меняем src (для дубликата - на уже добавленный файл)
+        return f'<img src="{item.file_name}"/>'
+
+    def _chapter_raw_html(self, content, attachments):
+        """
+        Исходный HTML главы: строка как есть, doc-формат через _doc_to_html,
+        для всего остального - пустая строка.
         """
         # 1) Если контент - строка (HTML)
         if isinstance(content, str):
-            raw_html = content
+            return content
         # 2) Если контент - dict (doc-формат)
-        elif isinstance(content, dict) and content.get("type") == "doc":
-            raw_html = self._doc_to_html(content, attachments)
-        else:
-            # не знаем, что это, вернём пустую строку
-            return ""
-
-        # Теперь обрабатываем получившийся HTML
-        soup = BeautifulSoup(raw_html, "html.parser")
-        all_imgs = soup.find_all("img")
-        for tag in all_imgs:
-            old_src = tag.get("src")
-            if not old_src:
-                continue
-            if old_src.startswith("imgs/"):
-                local_file = self.base_dir / old_src  # "output/imgs/filename.jpg" и т.п.
-                if local_file.exists():
-                    # Сжать + добавить
-                    new_data = self._compress_image(local_file)
-                    new_filename = "images/" + os.path.basename(local_file)
-                    # Добавляем в книгу
-                    item = epub.EpubItem(
-                        uid=f"img_{os.path.basename(old_src)}",
-                        file_name=new_filename,
-                        media_type="image/jpeg",
-                        content=new_data
-                    )
-                    self.book.add_item(item)
-
-                    # Меняем src
-                    tag["src"] = new_filename
-                else:
-                    logging.warning(f"Файл {local_file} не найден, пропускаем.")
-        return str(soup)
+        if isinstance(content, dict) and content.get("type") == "doc":
+            return self._doc_to_html(content, attachments)
+        # не знаем, что это
+        return ""
 
     def _doc_to_html(self, doc_content, attachments):
         """
@@ -232,28 +335,26 @@ class EpubCreator:
 
         # Для быстрого доступа: "имяБезРасширения" -> attachment["filename"]
         #   или просто сделаем словарь   image_name -> filename
-        name_map = {}
-        for att in attachments:
-            # Обычно att["filename"] = "8a57f2de.jpg"
-            # а в doc-е:   "image": "8a57f2de-df06-4a20-93af-a6e721fedfb2"
-            # Нужно сопоставить, часто это совпадает с `att["filename"]` без расширения,
-            # но бывает точное совпадение. Подгоняем логику под вашу структуру.
-            
-            # Если "images":[{"image":"17b9f599-efc3-4bee-8d15-9ad24da9dfac"}]
-            # тогда ищем attachment, у которого filename = "17b9f599-efc3-4bee-8d15-9ad24da9dfac.jpg"
-            base_name = os.path.splitext(att["filename"])[0]  # "17b9f599-efc3-4bee-8d15-9ad24da9dfac"
-            name_map[base_name] = att["filename"]
+        #   Обычно att["filename"] = "8a57f2de.jpg"
+        #   а в doc-е:   "image": "8a57f2de-df06-4a20-93af-a6e721fedfb2"
+        #   Нужно сопоставить, часто это совпадает с `att["filename"]` без расширения,
+        #   но бывает точное совпадение. Подгоняем логику под вашу структуру.
+        #
+        #   Если "images":[{"image":"17b9f599-efc3-4bee-8d15-9ad24da9dfac"}]
+        #   тогда ищем attachment, у которого filename = "17b9f599-efc3-4bee-8d15-9ad24da9dfac.jpg"
+        name_map = {os.path.splitext(att["filename"])[0]: att["filename"] for att in attachments}
 
         for node in content_arr:
             ntype = node.get("type")
 
             # 1) Абзац
             if ntype == "paragraph":
-                paragraph_text = ""
-                if "content" in node:
-                    for inline in node["content"]:
-                        if inline.get("type") == "text":
-                            paragraph_text += inline.get("text", "")
+                # Собираем куски текста и склеиваем один раз (без += в цикле)
+                paragraph_text = "".join([
+                    inline.get("text", "")
+                    for inline in node.get("content", ())
+                    if inline.get("type") == "text"
+                ])
                 if paragraph_text.strip():
                     html_parts.append(f"<p>{paragraph_text}</p>")
 
@@ -283,24 +384,41 @@ class EpubCreator:
 
     def _compress_image(self, img_path):
         """
-        Сжимаем (конвертируем) в JPEG, используем кэш, чтобы не обрабатывать повторно.
+        Возвращаем сжатую картинку: из пула процессов (если сжатие уже поставлено
+        через _start_image_compression) или сжимаем на месте.
+        Каждый путь сжимается один раз: повторные ссылки _rewrite_img берёт
+        из _path_to_item, а байты хранит только EpubItem в книге.
+        """
+        future = self._compress_futures.pop(img_path, None)
+        if future is not None:
+            return future.result()
+        return _compress_image_worker(img_path, self.image_quality, self.max_image_dim)
+
+    def _collect_image_paths(self):
+        """
+        Пути обложки и всех картинок глав (без повторов и несуществующих файлов)
+        в порядке сборки томов, чтобы первыми сжимались картинки, нужные первыми.
+        Заодно строит HTML каждой главы один раз и кладёт в self._raw_html
+        (id главы -> HTML) для _process_chapter_content.
         """
-        if img_path in self._image_cache:
-            return self._image_cache[img_path]
-
-        try:
-            with Image.open(img_path) as im:
-                if im.mode != "RGB":
-                    im = im.convert("RGB")
-                buf = io.BytesIO()
-                im.save(buf, format="JPEG", optimize=True, quality=self.image_quality)
-                buf.seek(0)
-                data = buf.read()
-                self._image_cache[img_path] = data
-                return data
-        except Exception as e:
-            logging.warning(f"Ошибка сжатия {img_path}: {e}")
-            return img_path.read_bytes()
+        paths = []
+        if self.ranobe_data.get("cover_image"):
+            paths.append(self.base_dir / self.ranobe_data["cover_image"])
+        for ch in (c for vol in self.sorted_vols for c in self.volumes_map[vol]):
+            raw_html = self._chapter_raw_html(ch["content"], ch.get("attachments", []))
+            self._raw_html[ch["id"]] = raw_html
+            paths.extend(self.base_dir / src for src in _LOCAL_IMG_RE.findall(raw_html))
+        return [path for path in dict.fromkeys(paths) if path.exists()]
+
+    def _start_image_compression(self, pool, paths):
+        """
+        Ставим в пул процессов сжатие картинок, чтобы они сжимались параллельно,
+        пока собираются страницы книги. Результаты забирает _compress_image.
+        """
+        for path in paths:
+            self._compress_futures[path] = pool.submit(
+                _compress_image_worker, path, self.image_quality, self.max_image_dim
+            )
 
     def _make_title_page(self, style_item):
         title = self.ranobe_data.get("title", "Без названия")
@@ -308,14 +426,9 @@ class EpubCreator:
         desc = self.ranobe_data.get("description", "")
 
         # Ссылка "Далее" -> первый том
-        volumes = [ch["volume"] for ch in self.ranobe_data["chapters"]]
         link = "#"
-        if volumes:
-            try:
-                first_vol = sorted(volumes, key=lambda x: float(x))[0]
-                link = f"volume_{first_vol}.xhtml#volume_{first_vol}"
-            except:
-                pass
+        if self.first_volume is not None:
+            link = f"volume_{self.first_volume}.xhtml#volume_{self.first_volume}"
 
         html = f"""
         <h1 style="text-align:center;">{title}</h1>
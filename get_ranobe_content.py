@@ -1,11 +1,20 @@
+import hashlib
+import html
 import logging
 import os
-import json
-import time
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 from pathlib import Path
+from urllib.parse import urlparse
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
-from bs4 import BeautifulSoup  # чтобы заменить ссылки прямо в HTML
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,12 +22,60 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 
+# Сколько глав и картинок качаем одновременно
+CHAPTER_WORKERS = 12
+IMAGE_WORKERS = 12
+
+# (connect, read) таймауты для всех запросов, в секундах
+REQUEST_TIMEOUT = (5, 30)
+
+# Тег <img> целиком и значение его src (в двойных или одинарных кавычках)
+_IMG_TAG_RE = re.compile(r'''<img\b[^>]*?(?<![\w-])src\s*=\s*(["'])(.*?)\1[^>]*>''', re.IGNORECASE)
+
+# Дисковый кэш ответов API с метаданными книги (инфо, обложка, список глав):
+# повторный запуск с той же ссылкой не ходит за ними в сеть.
+API_CACHE_NAME = ".ranobelib_cache"
+API_CACHE_EXPIRE = 24 * 60 * 60  # секунд
+
+def _setup_session(session):
+    """
+    Настраиваем сессию: переиспользуем TCP/TLS-соединения (keep-alive),
+    а повторы с экспоненциальной паузой делает сам urllib3.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,  # после последней попытки отдаём ответ как есть
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                      "(KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+        "Accept-Encoding": "gzip, deflate",
+    })
+    return session
+
+# Общая сессия для всех потоков (главы, картинки)
+SESSION = _setup_session(requests.Session())
+# Сессия с кэшем для метаданных книги
+API_SESSION = _setup_session(requests_cache.CachedSession(
+    API_CACHE_NAME,
+    expire_after=API_CACHE_EXPIRE,
+    allowable_codes=[200],
+    allowable_methods=["GET"],
+))
+
 def extract_book_id(url):
     """
     Извлекаем ID книги из URL (например /ru/book/1234--kniga, /ru/1234--kniga).
     Возвращаем '1234--kniga' или None, если не получилось.
     """
-    import re
     patterns = [
         r'/ru/book/(\d+--[\w-]+)',
         r'/ru/(\d+--[\w-]+)/',
@@ -34,7 +91,7 @@ def get_book_info(book_id):
     Получаем инфо о книге (название, описание).
     """
     api_url = f"https://api2.mangalib.me/api/manga/{book_id}?fields[]=summary"
-    r = requests.get(api_url)
+    r = API_SESSION.get(api_url, timeout=REQUEST_TIMEOUT)
     if r.status_code == 200:
         return r.json().get('data', {})
     return None
@@ -44,7 +101,7 @@ def get_cover_url(book_id):
     Получаем URL обложки.
     """
     api_url = f"https://api2.mangalib.me/api/manga/{book_id}"
-    r = requests.get(api_url)
+    r = API_SESSION.get(api_url, timeout=REQUEST_TIMEOUT)
     if r.status_code == 200:
         data = r.json().get('data', {})
         cover_data = data.get('cover', {})
@@ -56,125 +113,168 @@ def get_chapters_list(book_id):
     Получаем список глав: [ {"tom": int, "chapter": float, "name": str, "id": int}, ... ]
     """
     api_url = f"https://api2.mangalib.me/api/manga/{book_id}/chapters"
-    r = requests.get(api_url)
+    r = API_SESSION.get(api_url, timeout=REQUEST_TIMEOUT)
     if r.status_code == 200:
         data = r.json().get('data', [])
-        chapters = []
-        for ch in data:
-            chapters.append({
+        chapters = [
+            {
                 "tom": int(ch['volume']),
                 "chapter": float(ch['number']),
                 "name": ch['name'],
                 "id": ch['id']
-            })
-        chapters.sort(key=lambda x: (x['tom'], x['chapter']))
+            }
+            for ch in data
+        ]
+        chapters.sort(key=itemgetter('tom', 'chapter'))
         return chapters
     return []
 
-def get_chapter_data(book_id, volume, chapter, max_retries=5, sleep_time=1):
+def get_chapter_data(book_id, volume, chapter):
     """
     Получаем контент и вложения главы. Возвращаем словарь или None.
-    Повторяем до max_retries раз с паузой в sleep_time секунд,
-    если сервер не вернул код 200.
+    Повторы при ошибках сети и кодах 429/5xx делает адаптер SESSION.
     """
     if chapter.endswith('.0'):
         chapter = chapter.split('.')[0]
     api_url = f"https://api2.mangalib.me/api/manga/{book_id}/chapter?number={chapter}&volume={volume}"
 
-    for attempt in range(1, max_retries + 1):
-        try:
-            r = requests.get(api_url)
-            if r.status_code == 200:
-                return r.json().get('data')
-            else:
-                logging.warning(
-                    f"Не удалось загрузить главу (статус {r.status_code}), попытка {attempt}/{max_retries}"
-                )
-        except Exception as e:
-            logging.error(f"Ошибка при запросе главы: {e}")
-
-        if attempt < max_retries:
-            time.sleep(sleep_time)
-    # Если все попытки провалились, возвращаем None
+    try:
+        r = SESSION.get(api_url, timeout=REQUEST_TIMEOUT)
+        if r.status_code == 200:
+            return r.json().get('data')
+        logging.warning(f"Не удалось загрузить главу (статус {r.status_code})")
+    except Exception as e:
+        logging.error(f"Ошибка при запросе главы: {e}")
     return None
 
-def download_image(url, save_path, max_retries=5, sleep_time=1):
+def download_image(url, save_path):
     """
     Скачиваем картинку, сохраняем в save_path.
-    Повторяем до max_retries раз с паузой в sleep_time секунд,
-    если сервер не вернул код 200 или возникла ошибка.
+    Тело ответа пишется на диск потоком, кусками по 64 КБ, без буферизации в памяти.
+    Если файл уже скачан (непустой), повторно не качаем - это кэш между запусками.
+    Повторы при ошибках сети и кодах 429/5xx делает адаптер SESSION.
     """
-    for attempt in range(1, max_retries + 1):
-        try:
-            if url.startswith("https://"):
-                resp = requests.get(url)
-            else:
-                # если url типа "/uploads/...":
-                resp = requests.get(f"https://ranobelib.me{url}")
-
-            if resp.status_code == 200:
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                with open(save_path, "wb") as f:
-                    f.write(resp.content)
-                return True
-            else:
-                logging.warning(
-                    f"Не удалось скачать {url}, код {resp.status_code}, попытка {attempt}/{max_retries}"
-                )
-        except Exception as e:
-            logging.error(f"Ошибка скачивания {url}: {e}")
-
-        if attempt < max_retries:
-            time.sleep(sleep_time)
+    save_path = Path(save_path)
+    # Один stat() вместо exists() + stat(); пустой файл (остаток сбоя) качаем заново
+    try:
+        if save_path.stat().st_size > 0:
+            return True
+    except FileNotFoundError:
+        pass
+
+    if not url.startswith(("http://", "https://")):
+        # если url типа "/uploads/...":
+        url = f"https://ranobelib.me{url}"
+    # Пишем во временный файл, чтобы оборванная загрузка не попала в кэш
+    # У каждой загрузки свой временный файл, чтобы параллельные записи не мешали друг другу
+    tmp_path = save_path.with_name(f"{save_path.name}.{threading.get_ident()}.part")
+    try:
+        with SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT) as resp:
+            if resp.status_code != 200:
+                logging.warning(f"Не удалось скачать {url}, код {resp.status_code}")
+                return False
+            save_path.parent.mkdir(parents=True, exist_ok=True)
+            resp.raw.decode_content = True  # распаковываем gzip/deflate на лету
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(resp.raw, f, length=65536)
+        os.replace(tmp_path, save_path)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка скачивания {url}: {e}")
+        tmp_path.unlink(missing_ok=True)
     return False
 
-def fix_img_links_in_html(html_str, output_folder):
+class ImageDownloader:
+    """
+    Пул потоков для загрузки картинок.
+    Каждый файл качается не более одного раза за запуск: повторный submit
+    с тем же save_path (та же иллюстрация в нескольких главах, attachments,
+    совпадающие с <img>, в том числе по другому URL - абсолютному или
+    относительному) возвращает уже существующий future.
+    """
+
+    def __init__(self, max_workers=IMAGE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}  # путь сохранения -> Future[bool]
+        self._lock = threading.Lock()
+
+    def submit(self, url, save_path):
+        # Ключ - итоговый файл, а не URL: один файл пишет только одна загрузка,
+        # а один URL под двумя путями сохраняется в оба.
+        key = Path(save_path).resolve()
+        with self._lock:
+            fut = self._futures.get(key)
+            if fut is None:
+                fut = self._executor.submit(download_image, url, save_path)
+                self._futures[key] = fut
+            return fut
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown(wait=True)
+
+def fix_img_links_in_html(html_str, output_folder, downloader=None):
     """
     На вход: исходный HTML (как строка), где могут быть <img loading="lazy" src="https://ranobelib.me/...">
     Задача:
-      - Найти все <img src="..."> (используем BeautifulSoup).
+      - Найти все <img src="..."> (одной регуляркой, без построения DOM).
       - Для каждого img, скачать локально (imgs/filename.jpg).
-      - Заменить src="..." на "imgs/filename.jpg".
+      - Заменить тег целиком на <img src="imgs/filename.jpg"/> (заодно уходит loading="lazy").
+    Если передан downloader (ImageDownloader), картинки главы качаются параллельно.
     Возвращаем новый HTML со всеми локальными ссылками.
     """
-    soup = BeautifulSoup(html_str, "html.parser")
-    imgs = soup.find_all("img")
-    for tag in imgs:
-        # Удаляем loading="lazy", если не нужно
-        if 'loading' in tag.attrs:
-            del tag.attrs['loading']
-
-        src_val = tag.get("src")
-        if not src_val:
+    # Сначала собираем все внешние src -> (локальный путь, имя файла), потом качаем пачкой
+    targets = {}
+    for m in _IMG_TAG_RE.finditer(html_str):
+        src_val = m.group(2)
+        if src_val in targets:
             continue
-
         if src_val.startswith("http") or src_val.startswith("/uploads/"):
             # Извлекаем имя файла
-            from urllib.parse import urlparse, unquote
-            parsed = urlparse(src_val)
-            filename = os.path.basename(parsed.path)  # извлечём имя файла
+            filename = os.path.basename(urlparse(src_val).path)
             if not filename:
-                filename = "img_unknown.jpg"
-
-            local_path = Path(output_folder) / "imgs" / filename
-            if download_image(src_val, local_path):
-                tag["src"] = f"imgs/{filename}"
+                # Имя из хэша URL: у разных картинок без имени разные файлы,
+                # и кэш по имени файла не подставит чужую картинку
+                filename = f"img_{hashlib.sha1(src_val.encode()).hexdigest()[:16]}.jpg"
+            targets[src_val] = (Path(output_folder) / "imgs" / filename, filename)
         # Иначе, если уже локальная, не трогаем.
-    return str(soup)
 
-def fix_img_links_in_doc(doc_data, output_folder, attachments):
+    if downloader is not None:
+        futures = {src: downloader.submit(html.unescape(src), path) for src, (path, _) in targets.items()}
+        downloaded = {src: f.result() for src, f in futures.items()}
+    else:
+        downloaded = {src: download_image(html.unescape(src), path) for src, (path, _) in targets.items()}
+
+    def _rewrite(m):
+        src_val = m.group(2)
+        if downloaded.get(src_val):
+            src_val = f"imgs/{targets[src_val][1]}"
+        return f'<img src="{src_val}"/>'
+
+    return _IMG_TAG_RE.sub(_rewrite, html_str)
+
+def fix_img_links_in_doc(doc_data, output_folder, attachments, downloader=None):
     """
     Обработка контента в doc-формате (ProseMirror).
     Зависит от структуры doc_data и attachments.
     Здесь пример, где мы скачиваем файлы из attachments,
     но не меняем напрямую сам doc (если ссылки на изображения
     формируются автоматикой по имени).
+    Если передан downloader (ImageDownloader), загрузки ставятся в него и не ждут завершения.
     """
     for att in attachments:
         url = att['url']
         filename = att['filename']
         local_path = Path(output_folder) / "imgs" / filename
-        download_image(url, local_path)
+        if downloader is not None:
+            downloader.submit(url, local_path)
+        else:
+            download_image(url, local_path)
     return doc_data
 
 def get_ranobe_content(book_url, output_dir="output",progress=None):
@@ -203,75 +303,94 @@ def get_ranobe_content(book_url, output_dir="output",progress=None):
     if not book_id:
         raise ValueError("Не удалось извлечь ID книги")
 
-    info = get_book_info(book_id)
-    if not info:
-        raise ValueError("Не удалось получить инфо о книге")
-
-    # if progress:
-    progress(0.1, desc="Загрузка обложки")
-        
-
-    # Скачиваем обложку
-    cover_local = None
-    cover_url = get_cover_url(book_id)
-    if cover_url:
-        cover_filename = "cover" + Path(cover_url).suffix
-        cover_full_path = imgs_path / cover_filename
-        if download_image(cover_url, cover_full_path):
+    # Инфо о книге, URL обложки и список глав - независимые запросы: отправляем
+    # их сразу все и ждём только там, где нужен результат.
+    # Главы качаем в одном пуле потоков, картинки - в другом,
+    # чтобы ожидание картинок не занимало потоки загрузки глав.
+    with ThreadPoolExecutor(max_workers=3) as meta_ex, \
+            ThreadPoolExecutor(max_workers=CHAPTER_WORKERS) as chapter_ex, \
+            ImageDownloader(max_workers=IMAGE_WORKERS) as downloader:
+        info_future = meta_ex.submit(get_book_info, book_id)
+        cover_url_future = meta_ex.submit(get_cover_url, book_id)
+        chapters_future = meta_ex.submit(get_chapters_list, book_id)
+
+        info = info_future.result()
+        if not info:
+            raise ValueError("Не удалось получить инфо о книге")
+
+        # if progress:
+        progress(0.1, desc="Загрузка обложки")
+
+        # Обложку ставим в очередь загрузки картинок и не ждём
+        cover_local = None
+        cover_future = None
+        cover_url = cover_url_future.result()
+        if cover_url:
+            # Имя с book_id: в общей папке output обложка другой книги не попадёт в кэш
+            cover_filename = f"cover_{book_id}{Path(cover_url).suffix}"
+            cover_future = downloader.submit(cover_url, imgs_path / cover_filename)
+
+        # if progress:
+        progress(0.15, desc="Получение списка глав")
+
+        # Получаем список глав
+        chapters_list = chapters_future.result()
+        logging.info(f"Найдено глав: {len(chapters_list)}")
+
+        futures = {
+            chapter_ex.submit(get_chapter_data, book_id, str(c['tom']), str(c['chapter'])): idx
+            for idx, c in enumerate(chapters_list)
+        }
+        results = [None] * len(chapters_list)
+
+        # Используем progress.tqdm для отслеживания прогресса
+        done_iter = progress.tqdm(as_completed(futures), total=len(futures), desc="Загрузка глав")
+
+        for fut in done_iter:
+            idx = futures[fut]
+            ch = chapters_list[idx]
+            tom = str(ch['tom'])
+            chap_str = str(ch['chapter'])
+            ch_data = fut.result()
+            if not ch_data:
+                logging.warning(f"Пропускаем главу {tom} {chap_str} (не удалось загрузить).")
+                continue
+
+            attachments = ch_data.get("attachments", [])
+            content = ch_data.get("content", "")
+
+            # Если контент строковый (HTML)
+            if isinstance(content, str):
+                new_html = fix_img_links_in_html(content, out_path, downloader)
+                content = new_html
+            # Если контент doc-формат
+            elif isinstance(content, dict) and content.get("type") == "doc":
+                content = fix_img_links_in_doc(content, out_path, attachments, downloader)
+
+            # Скачиваем все attachments (часто совпадают с изображениями в тексте;
+            # уже поставленные в очередь под тем же imgs/<filename> downloader
+            # повторно не качает)
+            for att in attachments:
+                url = att["url"]
+                fname = att["filename"]
+                local_file = imgs_path / fname
+                downloader.submit(url, local_file)
+
+            # Формируем запись о главе
+            results[idx] = {
+                "id": ch_data["id"],
+                "volume": ch_data["volume"],
+                "chapter": ch_data["number"],
+                "name": ch_data["name"],
+                "attachments": attachments,
+                "content": content
+            }
+
+        if cover_future is not None and cover_future.result():
             cover_local = f"imgs/{cover_filename}"
 
-    # if progress:
-    progress(0.15, desc="Получение списка глав")
-        
-
-    # Получаем список глав
-    chapters_list = get_chapters_list(book_id)
-    logging.info(f"Найдено глав: {len(chapters_list)}")
-
-    all_chapters = []
-
-    # Используем progress.tqdm для отслеживания прогресса
-    if True:
-        chapters_iter = progress.tqdm(chapters_list, desc="Загрузка глав")
-    # else:
-    #     chapters_iter = tqdm(chapters_list, desc="Загрузка глав")
-        
-    for ch in chapters_iter:
-        tom = str(ch['tom'])
-        chap_str = str(ch['chapter'])
-        ch_data = get_chapter_data(book_id, tom, chap_str)
-        if not ch_data:
-            logging.warning(f"Пропускаем главу {tom} {chap_str} (не удалось загрузить).")
-            continue
-
-        attachments = ch_data.get("attachments", [])
-        content = ch_data.get("content", "")
-
-        # Если контент строковый (HTML)
-        if isinstance(content, str):
-            new_html = fix_img_links_in_html(content, out_path)
-            content = new_html
-        # Если контент doc-формат
-        elif isinstance(content, dict) and content.get("type") == "doc":
-            content = fix_img_links_in_doc(content, out_path, attachments)
-
-        # Скачиваем все attachments (часто совпадают с изображениями в тексте)
-        for att in attachments:
-            url = att["url"]
-            fname = att["filename"]
-            local_file = imgs_path / fname
-            download_image(url, local_file)
-
-        # Формируем запись о главе
-        chapter_rec = {
-            "id": ch_data["id"],
-            "volume": ch_data["volume"],
-            "chapter": ch_data["number"],
-            "name": ch_data["name"],
-            "attachments": attachments,
-            "content": content
-        }
-        all_chapters.append(chapter_rec)
+    # Главы приходят в порядке готовности - возвращаем исходный порядок (том, глава)
+    all_chapters = [rec for rec in results if rec is not None]
 
     # if progress:
     progress(0.95, desc="Сохранение результатов")
@@ -288,8 +407,10 @@ def get_ranobe_content(book_url, output_dir="output",progress=None):
     }
 
     ranobe_json_path = out_path / "ranobe.json"
-    with open(ranobe_json_path, "w", encoding="utf-8") as f:
-        json.dump(ranobe_data, f, ensure_ascii=False, indent=2)
+    # orjson сразу отдаёт UTF-8 байты - пишем их одним вызовом write()
+    ranobe_json_path.write_bytes(
+        orjson.dumps(ranobe_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    )
     logging.info(f"Сохранён ranobe.json: {ranobe_json_path}")
     
     # if progress: